@@ -1,4 +1,10 @@
+import argparse
+import os
+
+from profiler import start_profiling, write_profile
+from retagger import Retagger
 from spotify_api import SpotifyAPI
+from sync_daemon import SyncDaemon
 from utils import Utils
 
 
@@ -21,14 +27,78 @@ def get_playlist_index(playlists):
     return None
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Download the tracks of your Spotify playlists.")
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Run as a resident sync service with a local job API "
+             "(see SYNC_PLAYLISTS, SYNC_INTERVAL & DAEMON_PORT in .env)")
+    parser.add_argument(
+        "--retag",
+        action="store_true",
+        help="Refresh the tags of already downloaded tracks from Spotify "
+             "instead of downloading new ones")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Record CPU & memory profiles of the sync, written to a 'profiles' "
+             "directory next to the downloaded tracks")
+    parser.add_argument(
+        "--profile-stacks",
+        action="store_true",
+        help="With --profile, also sample collapsed stacks for a flamegraph")
+    return parser.parse_args()
+
+
+def start_run_profiling(args):
+    if not args.profile:
+        return None
+    return start_profiling(collapsed_stacks=args.profile_stacks)
+
+
+def write_run_profile(profiler, output_dir):
+    if profiler is not None:
+        write_profile(profiler, output_dir)
+
+
+def retag_tracks(args, spotify_api, token, playlist_id, existing_tracks, playlist_name):
+    print("Retagging tracks...")
+
+    profiler = start_run_profiling(args)
+    try:
+        number_of_retags, number_of_unchanged, number_of_failures, number_of_unmatched = Retagger(
+            spotify_api).retag_playlist(playlist_id, token, existing_tracks, playlist_name)
+    finally:
+        write_run_profile(profiler, os.path.join(
+            spotify_api.downloads_dir, playlist_name))
+
+    print("\nRetagging complete.")
+    print(f"\nTracks retagged: {number_of_retags}")
+    print(f"Tracks unchanged: {number_of_unchanged}")
+    print(f"Tracks failed: {number_of_failures}")
+    print(f"Files not in the playlist: {number_of_unmatched}")
+
+
 def main():
+    args = parse_args()
+
     # Initialize classes
     spotify_api = SpotifyAPI()
     utils = Utils()
 
-    # Get user auth, token & playlists
+    # Get user auth & token
     spotify_api.get_user_auth()
     token = spotify_api.get_token()
+
+    if args.daemon:
+        # Syncs run on the daemon's worker thread, which profiles each job itself
+        SyncDaemon(spotify_api, utils, token, args.profile,
+                   args.profile_stacks).run()
+        return
+
+    # Get playlists
     playlists = spotify_api.get_playlists(token)
 
     # Display playlists
@@ -50,12 +120,23 @@ def main():
     utils.create_playlist_directory(sanitized_playlist_name)
     existing_tracks = utils.get_existing_tracks(sanitized_playlist_name)
 
-    # Get tracks from chosen playlist
     print(f"Number of existing tracks: {len(existing_tracks)}\n")
+
+    if args.retag:
+        retag_tracks(args, spotify_api, token, playlist_id,
+                     existing_tracks, sanitized_playlist_name)
+        return
+
+    # Get tracks from chosen playlist
     print("Downloading tracks...")
 
-    tracks_not_found, number_of_downloads, number_of_skips = spotify_api.get_tracks(
-        playlist_id, token, existing_tracks, sanitized_playlist_name)
+    profiler = start_run_profiling(args)
+    try:
+        tracks_not_found, number_of_downloads, number_of_skips = spotify_api.get_tracks(
+            playlist_id, token, existing_tracks, sanitized_playlist_name)
+    finally:
+        write_run_profile(profiler, os.path.join(
+            utils.downloads_dir, sanitized_playlist_name))
 
     print("\nAll downloads complete.")
     print(f"\nTracks downloaded: {number_of_downloads}")
@@ -0,0 +1,121 @@
+import time
+
+import requests
+
+from utils import Utils
+
+
+class MetadataEnricher:
+    """
+    Add album and artist details (release year, track & disc numbers, genres)
+    to the track metadata.
+
+    Unique album and artist IDs are collected from all tracks and resolved through
+    the Spotify batch endpoints, and every album and artist is only fetched once
+    per run, so the number of requests grows with the number of distinct albums
+    and artists rather than the number of tracks.
+
+    Attributes:
+    -----------
+    session : requests.Session
+        The HTTP session used for Spotify API requests
+    albums : dict[str, dict | None]
+        Album responses keyed by album ID, None if Spotify does not know the album
+    artists : dict[str, dict | None]
+        Artist responses keyed by artist ID, None if Spotify does not know the artist
+
+    Methods:
+    --------
+    enrich(track_details, token):
+        Add album & artist details to the metadata of each track.
+    """
+
+    albums_url = "https://api.spotify.com/v1/albums"
+    artists_url = "https://api.spotify.com/v1/artists"
+    # Maximum number of IDs per request allowed by the batch endpoints
+    albums_batch_size = 20
+    artists_batch_size = 50
+    # Longest rate limit wait (seconds) before a batch is skipped instead
+    max_retry_after = 30
+
+    def __init__(self, session: requests.Session):
+        self.session: requests.Session = session
+        self.albums: dict[str, dict | None] = {}
+        self.artists: dict[str, dict | None] = {}
+
+    def enrich(self, track_details: list[dict], token: str) -> None:
+        album_ids = {metadata["album_id"]
+                     for metadata in track_details if metadata["album_id"]}
+        artist_ids = {artist_id
+                      for metadata in track_details for artist_id in metadata["artist_ids"]}
+
+        self.fetch(self.albums_url, "albums", album_ids,
+                   self.albums, self.albums_batch_size, token)
+        self.fetch(self.artists_url, "artists", artist_ids,
+                   self.artists, self.artists_batch_size, token)
+
+        for metadata in track_details:
+            self.enrich_track(metadata)
+
+    def enrich_track(self, metadata: dict) -> None:
+        album = self.albums.get(metadata["album_id"])
+        if album is not None:
+            if album.get("release_date"):
+                metadata["year"] = album["release_date"][:4]
+            if album.get("total_tracks"):
+                metadata["total_tracks"] = album["total_tracks"]
+
+        # Album genres are the most specific, fall back to the genres of the track's artists
+        genres = list(album.get("genres") or []) if album is not None else []
+        if not genres:
+            for artist_id in metadata["artist_ids"]:
+                artist = self.artists.get(artist_id)
+                if artist is not None:
+                    genres.extend(artist.get("genres") or [])
+
+        metadata["genres"] = list(dict.fromkeys(genres))
+
+    def fetch(self, url, key, ids, cache, batch_size, token) -> None:
+        missing_ids = sorted(ids - cache.keys())
+        headers = {"Authorization": "Bearer " + token}
+
+        for i in range(0, len(missing_ids), batch_size):
+            batch = missing_ids[i:i + batch_size]
+            items = self.get_batch(url, key, batch, headers)
+
+            # A failed batch is left uncached, so the next sync tries it again
+            if items is None:
+                continue
+
+            # The batch endpoints answer in request order, with null for unknown IDs
+            for item_id, item in zip(batch, items):
+                cache[item_id] = item
+
+    def get_batch(self, url, key, batch, headers) -> list[dict | None] | None:
+        # Retry once if rate limited
+        for _ in range(2):
+            try:
+                response = self.session.get(
+                    url, headers=headers, params={"ids": ",".join(batch)}, timeout=10)
+            except requests.exceptions.RequestException as e:
+                Utils.console_print(
+                    f"An error occurred while fetching {key}: {e}")
+                return None
+
+            if response.status_code == 429:
+                retry_after = int(response.headers.get("Retry-After", "1"))
+                if retry_after > self.max_retry_after:
+                    Utils.console_print(
+                        f"Rate limited while fetching {key}, skipping {len(batch)} {key} for now.")
+                    return None
+                time.sleep(retry_after)
+                continue
+
+            if response.status_code != 200:
+                Utils.console_print(
+                    f"An error occurred while fetching {key}: {response.status_code}")
+                return None
+
+            return response.json().get(key, [])
+
+        return None
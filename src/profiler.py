@@ -0,0 +1,244 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+from utils import Utils
+
+
+class Profiler:
+    """
+    Collect CPU and memory profiles for a run (--profile).
+
+    cProfile records the thread that started the profiler, stage timings are
+    recorded for every thread (searches run on the prefetch threads), and
+    tracemalloc snapshots are taken at stage boundaries as memory grows. With collapsed stacks enabled, all threads are also
+    sampled periodically to produce input for flamegraph.pl or speedscope.
+
+    Attributes:
+    -----------
+    collapsed_stacks : bool
+        Whether to sample stacks for a flamegraph
+    sample_interval : float
+        Seconds between stack samples
+    stage_stats : dict[str, dict[str, float]]
+        Number of calls, total time, peak traced memory and traced memory
+        at the last snapshot per stage
+    first_snapshots : dict[str, tracemalloc.Snapshot]
+        The snapshot taken after the first call of each stage
+    peak_snapshots : dict[str, tracemalloc.Snapshot]
+        The latest snapshot of each stage, taken once memory had grown by
+        snapshot_growth since the one before
+
+    Methods:
+    --------
+    start():
+        Start profiling.
+    stop():
+        Stop profiling.
+    stage(name):
+        Context manager recording the time and memory of a stage.
+    write_reports(output_dir):
+        Write the profiles and reports to a directory.
+    """
+
+    # Frames kept per traced allocation
+    traceback_limit = 25
+    # Lines listed per stage in the memory report
+    top_allocations = 25
+    # Growth in traced memory (bytes) since a stage's last snapshot before another one is taken
+    snapshot_growth = 8 * 1024 * 1024
+
+    def __init__(self, collapsed_stacks=False, sample_interval=0.005):
+        self.collapsed_stacks = collapsed_stacks
+        self.sample_interval = sample_interval
+        self.cpu_profile = cProfile.Profile()
+        self.stage_stats: dict[str, dict[str, float]] = {}
+        self.first_snapshots: dict[str, tracemalloc.Snapshot] = {}
+        self.peak_snapshots: dict[str, tracemalloc.Snapshot] = {}
+        self.stack_samples: Counter[str] = Counter()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.sampler = None
+        self.started_at = 0.0
+        self.stopped_at = 0.0
+        self.peak_traced = 0
+
+    def start(self):
+        self.started_at = time.time()
+        tracemalloc.start(self.traceback_limit)
+        if self.collapsed_stacks:
+            self.sampler = threading.Thread(
+                target=self.sample_stacks, daemon=True)
+            self.sampler.start()
+        self.cpu_profile.enable()
+
+    def stop(self):
+        self.cpu_profile.disable()
+        self.stop_event.set()
+        if self.sampler is not None:
+            self.sampler.join()
+        self.stopped_at = time.time()
+
+        # Read the peak before tracing is switched off, tracing slows down every allocation
+        _current, self.peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            current, _peak = tracemalloc.get_traced_memory()
+
+            with self.lock:
+                stats = self.stage_stats.setdefault(
+                    name, {"calls": 0, "total_time": 0.0, "max_traced": 0, "snapshot_traced": None})
+                stats["calls"] += 1
+                stats["total_time"] += elapsed
+                stats["max_traced"] = max(stats["max_traced"], current)
+
+                # Snapshots are costly, so one is only taken on the first call and then
+                # each time memory has grown by snapshot_growth since the last one
+                take_snapshot = tracemalloc.is_tracing() and (
+                    stats["snapshot_traced"] is None or
+                    current >= stats["snapshot_traced"] + self.snapshot_growth
+                )
+                if take_snapshot:
+                    stats["snapshot_traced"] = current
+
+            if take_snapshot:
+                snapshot = tracemalloc.take_snapshot()
+                with self.lock:
+                    self.first_snapshots.setdefault(name, snapshot)
+                    self.peak_snapshots[name] = snapshot
+
+    def sample_stacks(self):
+        sampler_id = threading.get_ident()
+        thread_names = {}
+
+        while not self.stop_event.wait(self.sample_interval):
+            if len(thread_names) != threading.active_count():
+                thread_names = {
+                    thread.ident: thread.name for thread in threading.enumerate()}
+
+            for thread_id, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if thread_id == sampler_id:
+                    continue
+
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+
+                frames.append(thread_names.get(thread_id, str(thread_id)))
+                self.stack_samples[";".join(reversed(frames))] += 1
+
+    def write_reports(self, output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.cpu_profile.dump_stats(os.path.join(output_dir, "cpu.prof"))
+
+        cpu_report = io.StringIO()
+        stats = pstats.Stats(self.cpu_profile, stream=cpu_report)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(50)
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(50)
+        with open(os.path.join(output_dir, "cpu.txt"), "w", encoding="utf-8") as file:
+            file.write(cpu_report.getvalue())
+
+        if self.collapsed_stacks:
+            with open(os.path.join(output_dir, "stacks.collapsed"), "w", encoding="utf-8") as file:
+                for stack, count in self.stack_samples.most_common():
+                    file.write(f"{stack} {count}\n")
+
+        with open(os.path.join(output_dir, "memory.txt"), "w", encoding="utf-8") as file:
+            file.write(self.format_memory_report())
+
+        with open(os.path.join(output_dir, "summary.txt"), "w", encoding="utf-8") as file:
+            file.write(self.format_summary())
+
+        return output_dir
+
+    def format_summary(self):
+        lines = [
+            f"Wall time: {self.stopped_at - self.started_at:.2f}s",
+            f"Peak traced memory: {self.peak_traced / 1024 / 1024:.2f} MiB",
+            "",
+            f"{'Stage':<24}{'Calls':>8}{'Total (s)':>12}{'Average (s)':>14}{'Max traced (MiB)':>20}",
+        ]
+        for name, stats in sorted(
+            self.stage_stats.items(), key=lambda item: item[1]["total_time"], reverse=True
+        ):
+            lines.append(
+                f"{name:<24}{stats['calls']:>8}{stats['total_time']:>12.2f}"
+                f"{stats['total_time'] / stats['calls']:>14.3f}"
+                f"{stats['max_traced'] / 1024 / 1024:>20.2f}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def format_memory_report(self):
+        lines = []
+        for name, snapshot in self.peak_snapshots.items():
+            lines.append(f"=== {name}: top allocations at peak ===")
+            for stat in snapshot.statistics("lineno")[:self.top_allocations]:
+                lines.append(str(stat))
+
+            lines.append(f"\n=== {name}: growth since first call ===")
+            growth = snapshot.compare_to(self.first_snapshots[name], "lineno")
+            for stat in growth[:self.top_allocations]:
+                lines.append(str(stat))
+            lines.append("")
+        return "\n".join(lines) + "\n"
+
+
+active_profiler: Profiler | None = None
+
+
+def start_profiling(collapsed_stacks=False):
+    """
+    Start a profiler on the calling thread and make it the active one.
+    cProfile only records the thread that enabled it, so call this on the thread doing the sync.
+    """
+    profiler = Profiler(collapsed_stacks=collapsed_stacks)
+    set_active_profiler(profiler)
+    profiler.start()
+    return profiler
+
+
+def write_profile(profiler, output_dir, name=None):
+    profiler.stop()
+    set_active_profiler(None)
+
+    if name is None:
+        name = time.strftime("%Y%m%d-%H%M%S")
+    profile_dir = os.path.join(output_dir, "profiles", name)
+    profiler.write_reports(profile_dir)
+    Utils.console_print(f"\nProfile written to {profile_dir}")
+
+
+def set_active_profiler(profiler):
+    global active_profiler  # pylint: disable=global-statement
+    active_profiler = profiler
+
+
+@contextmanager
+def profile_stage(name):
+    """
+    Record a stage with the active profiler, does nothing without --profile.
+    """
+    if active_profiler is None:
+        yield
+        return
+
+    with active_profiler.stage(name):
+        yield
@@ -0,0 +1,206 @@
+import os
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from mutagen.mp3 import MP3
+from mutagen.id3 import ID3
+
+from profiler import profile_stage
+from utils import Utils
+from youtube_api import YoutubeAPI
+
+
+class Retagger:
+    """
+    Refresh the tags of already downloaded tracks from Spotify, without downloading audio.
+
+    Existing files are matched to the playlist's tracks by the Spotify track ID stored
+    in the file, or by file name for files without one. Files are renamed when the
+    track's title or artist changed, and only the frames that differ are rewritten.
+    Files are processed in parallel (RETAG_WORKERS) and album art is downloaded at
+    most once per cover URL, and only when the cover URL stored in the file no
+    longer matches.
+
+    Attributes:
+    -----------
+    spotify_api : SpotifyAPI
+        The authorized Spotify API instance used to fetch the playlist
+    downloads_dir : str | None
+        The directory where downloaded tracks are saved
+    workers : int
+        Number of files retagged in parallel
+    cover_art_cache : dict[str, bytes | None]
+        Downloaded album art, keyed by cover URL
+
+    Methods:
+    --------
+    retag_playlist(playlist_id, token, existing_tracks, playlist_name):
+        Retag the existing files of a playlist.
+    retag_file(mp3_file, metadata):
+        Retag a single file, returns "retagged", "unchanged" or "failed".
+    """
+
+    def __init__(self, spotify_api, workers=None):
+        self.spotify_api = spotify_api
+        self.downloads_dir = os.getenv("DOWNLOADS_DIR")
+        if workers is None:
+            workers = int(os.getenv("RETAG_WORKERS", "8"))
+        self.workers = max(1, workers)
+        self.cover_art_cache: dict[str, bytes | None] = {}
+        self.lock = threading.Lock()
+        self.rename_lock = threading.Lock()
+
+    def retag_playlist(self, playlist_id, token, existing_tracks, playlist_name):
+        with profile_stage("get_track_response"):
+            track_response = self.spotify_api.get_track_response(
+                playlist_id, token)
+        with profile_stage("extract_track_details"):
+            track_details = self.spotify_api.extract_track_details(
+                track_response)
+
+        playlist_path = os.path.join(self.downloads_dir, playlist_name)
+        existing_tracks = list(dict.fromkeys(existing_tracks))
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="retag") as executor:
+            file_track_ids = dict(zip(existing_tracks, executor.map(
+                self.read_track_id,
+                [os.path.join(playlist_path, title + ".mp3") for title in existing_tracks]
+            )))
+
+        matched_files = self.match_files(file_track_ids, track_details)
+        matched_tracks = list(matched_files.values())
+
+        with profile_stage("enrich_track_details"):
+            self.spotify_api.metadata_enricher.enrich(matched_tracks, token)
+
+        results = Counter()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="retag") as executor:
+            futures = [
+                executor.submit(
+                    self.retag_file,
+                    os.path.join(playlist_path, file_title + ".mp3"),
+                    metadata
+                )
+                for file_title, metadata in matched_files.items()
+            ]
+            for future in futures:
+                results[future.result()] += 1
+
+        number_of_unmatched = len(existing_tracks) - len(matched_tracks)
+        return results["retagged"], results["unchanged"], results["failed"], number_of_unmatched
+
+    @staticmethod
+    def match_files(file_track_ids, track_details):
+        """
+        Match existing files to tracks, by the Spotify track ID stored in the file
+        and otherwise by file name. Each track is matched to at most one file.
+        Returns the matched tracks keyed by file name.
+        """
+        tracks_by_id = {
+            metadata["track_id"]: metadata for metadata in track_details if metadata["track_id"]}
+        tracks_by_title = {
+            metadata["title"]: metadata for metadata in track_details}
+
+        matched_files = {}
+        matched_keys = set()
+
+        # IDs first, a renamed track must not be claimed by a file that only shares its old name
+        for file_title, track_id in file_track_ids.items():
+            metadata = tracks_by_id.get(track_id)
+            if metadata is not None and track_id not in matched_keys:
+                matched_files[file_title] = metadata
+                matched_keys.add(track_id)
+
+        for file_title in file_track_ids:
+            metadata = tracks_by_title.get(file_title)
+            if file_title in matched_files or metadata is None:
+                continue
+            key = metadata["track_id"] or metadata["title"]
+            if key not in matched_keys:
+                matched_files[file_title] = metadata
+                matched_keys.add(key)
+
+        return matched_files
+
+    @staticmethod
+    def read_track_id(mp3_file):
+        try:
+            tags = MP3(mp3_file, ID3=ID3).tags
+        except Exception:
+            return None
+        track_id = tags.get("TXXX:Spotify Track ID") if tags is not None else None
+        return track_id.text[0] if track_id is not None else None
+
+    def rename_file(self, mp3_file, metadata):
+        """
+        Rename a file to match the track's current title & artist.
+        Returns the path of the file, renamed or not.
+        """
+        new_file = os.path.join(os.path.dirname(mp3_file), metadata["title"] + ".mp3")
+        if new_file == mp3_file:
+            return mp3_file
+
+        # Checked & renamed under a lock, two tracks can end up with the same title & artist
+        # (a single and its album version) and one file must not replace the other
+        with self.rename_lock:
+            if os.path.exists(new_file):
+                Utils.console_print(
+                    f"Not renaming \"{os.path.basename(mp3_file)}\", "
+                    f"\"{os.path.basename(new_file)}\" already exists.")
+                return mp3_file
+
+            os.replace(mp3_file, new_file)
+        return new_file
+
+    def get_cover_art(self, image_url):
+        with self.lock:
+            if image_url in self.cover_art_cache:
+                return self.cover_art_cache[image_url]
+
+        with profile_stage("download_track_image"):
+            image_response = self.spotify_api.download_track_image(image_url)
+        cover_art = image_response.content if image_response is not None else None
+
+        with self.lock:
+            self.cover_art_cache[image_url] = cover_art
+        return cover_art
+
+    @staticmethod
+    def has_current_cover_art(mp3_file, metadata):
+        tags = MP3(mp3_file, ID3=ID3).tags
+        if tags is None or not tags.getall("APIC"):
+            return False
+        cover_art_url = tags.get("TXXX:Cover Art URL")
+        return cover_art_url is not None and cover_art_url.text == [metadata["cover_art_url"]]
+
+    def retag_file(self, mp3_file, metadata):
+        try:
+            renamed_file = self.rename_file(mp3_file, metadata)
+            renamed = renamed_file != mp3_file
+            mp3_file = renamed_file
+
+            # A missing cover is left out of the comparison, the existing one stays in place
+            if metadata["cover_art_url"] and not self.has_current_cover_art(mp3_file, metadata):
+                metadata["cover_art"] = self.get_cover_art(
+                    metadata["cover_art_url"])
+
+            with profile_stage("update_metadata"):
+                changed_frames = YoutubeAPI.update_metadata(mp3_file, metadata)
+        except Exception as e:
+            Utils.console_print(
+                f"An error occurred while retagging \"{metadata['search_string']}\": {e}")
+            return "failed"
+
+        # TXXX only holds the bookkeeping for later retags (cover URL & track ID), adding it
+        # to files downloaded before it existed is not a tag fix and is not reported
+        changed_frames = [frame_id for frame_id in changed_frames if frame_id != "TXXX"]
+        if renamed:
+            changed_frames.append("file name")
+
+        if not changed_frames:
+            return "unchanged"
+
+        Utils.console_print(
+            f"Retagged \"{metadata['search_string']}\" ({', '.join(changed_frames)})")
+        return "retagged"
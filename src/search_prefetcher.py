@@ -0,0 +1,72 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+
+
+class SearchPrefetcher:
+    """
+    Resolve YouTube searches for upcoming tracks ahead of the downloader.
+
+    At most `lookahead` searches are queued or running at any time, so the
+    downloader always has a few resolved URLs ready without flooding the
+    search endpoint with every track of the playlist at once.
+
+    Attributes:
+    -----------
+    search : Callable[[str], tuple[str | None, str | None]]
+        The search function, returns the video URL and title for a search string
+    lookahead : int
+        How many tracks ahead of the downloader to resolve, set with SEARCH_LOOKAHEAD
+    on_not_found : Callable[[dict], None] | None
+        Called as soon as a search comes back without a result
+
+    Methods:
+    --------
+    resolve(track_details):
+        Yield (metadata, video_url, video_title) for each track, in order.
+    """
+
+    # Searches are short compared to downloads, a couple of workers keep up with the downloader
+    max_workers = 2
+
+    def __init__(self, search, lookahead=None, on_not_found=None):
+        self.search = search
+        if lookahead is None:
+            lookahead = int(os.getenv("SEARCH_LOOKAHEAD", "5"))
+        self.lookahead = max(1, lookahead)
+        self.on_not_found = on_not_found
+
+    def submit(self, executor, metadata) -> tuple[dict, Future]:
+        future = executor.submit(self.search, metadata["search_string"])
+        if self.on_not_found is not None:
+            future.add_done_callback(
+                lambda done: self.report_not_found(done, metadata))
+        return metadata, future
+
+    def report_not_found(self, future, metadata) -> None:
+        if future.exception() is None and future.result()[0] is None:
+            self.on_not_found(metadata)
+
+    def resolve(self, track_details):
+        tracks = iter(track_details)
+        pending = deque()
+
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_workers, self.lookahead),
+            thread_name_prefix="search"
+        ) as executor:
+            for metadata in tracks:
+                pending.append(self.submit(executor, metadata))
+                if len(pending) >= self.lookahead:
+                    break
+
+            while pending:
+                metadata, future = pending.popleft()
+
+                # Keep the window full while the caller works on this track
+                upcoming = next(tracks, None)
+                if upcoming is not None:
+                    pending.append(self.submit(executor, upcoming))
+
+                video_url, video_title = future.result()
+                yield metadata, video_url, video_title
@@ -8,12 +8,21 @@ from http.server import HTTPServer, BaseHTTPRequestHandler
 
 import dotenv
 import requests
-from requests import Response, get, post
+from requests import Response
 
+from metadata_enricher import MetadataEnricher
+from profiler import profile_stage
+from search_prefetcher import SearchPrefetcher
 from utils import Utils
 from youtube_api import YoutubeAPI
 
 
+class SpotifyTokenError(Exception):
+    """
+    Raised when an access token could not be fetched from the Spotify accounts service.
+    """
+
+
 class CustomHTTPServer(HTTPServer):
     """
     Custom HTTPServer class to store the authorization code
@@ -123,6 +132,18 @@ class SpotifyAPI:
         The directory where downloaded tracks will be saved
     auth_code : str | None
         The authorization code returned by the Spotify authorization server
+    refresh_token : str | None
+        The refresh token returned alongside the access token
+    token_expires_at : float
+        The time (epoch seconds) at which the current access token expires
+    session : requests.Session
+        Shared HTTP session, keeps connections to the Spotify API alive between requests
+    youtube_api : YoutubeAPI
+        Shared YouTube API instance, keeps the yt-dlp engine alive between downloads
+    track_response_cache : dict[str, tuple[str, list[dict[str, str]]]]
+        Track responses keyed by playlist ID, stored with the playlist snapshot ID
+    metadata_enricher : MetadataEnricher
+        Adds album & artist details to the track metadata, memoised per album & artist
 
     Methods:
     --------
@@ -130,6 +151,10 @@ class SpotifyAPI:
         Get the authorization code from the Spotify authorization server.
     get_token():
         Get the access token from the Spotify API.
+    refresh_access_token():
+        Get a new access token using the stored refresh token.
+    get_valid_token(token):
+        Return the given token, or a refreshed one if it is about to expire.
     get_auth_header(token):
         Build the authorization header for Spotify API requests.
     get_playlist_response(token):
@@ -138,13 +163,13 @@ class SpotifyAPI:
         Extract the playlist name and ID from the playlist response.
     get_playlists(token):
         Fetch the user's playlists & extract the playlist name and ID.
-    get_track_response(playlist_id, token):
+    get_track_response(playlist_id, token, snapshot_id):
         Fetch the tracks from a playlist in the Spotify API.
     extract_track_details(track_response):
         Extract the track metadata from the track response.
     download_track_image(image_url):
         Download the album art for a track.
-    get_tracks(playlist_id, token, existing_tracks, playlist_name):
+    get_tracks(playlist_id, token, existing_tracks, playlist_name, snapshot_id):
         Download the tracks from a playlist.
     should_skip_track(metadata, existing_tracks):
         Check if a track should be skipped.
@@ -169,6 +194,8 @@ class SpotifyAPI:
         Log that a track is being skipped.
     log_image_download_error(metadata):
         Log an error downloading the album art.
+    log_track_not_found(metadata):
+        Log that no video was found for a track.
     log_download_progress(number_of_downloads, number_of_tracks, total_download_time):
         Log the download progress.
     """
@@ -182,6 +209,13 @@ class SpotifyAPI:
         self.redirect_uri: str = "http://localhost:8080/callback"
         self.downloads_dir: str | None = os.getenv("DOWNLOADS_DIR")
         self.auth_code: str | None = None
+        self.refresh_token: str | None = None
+        self.token_expires_at: float = 0.0
+        self.session: requests.Session = requests.Session()
+        self.youtube_api: YoutubeAPI = YoutubeAPI()
+        self.track_response_cache: dict[str, tuple[str, list[dict[str, str]]]] = {}
+        self.metadata_enricher: MetadataEnricher = MetadataEnricher(
+            self.session)
 
         if not self.client_id or not self.client_secret or not self.user_id:
             print(
@@ -238,6 +272,60 @@ class SpotifyAPI:
             Returns:
                     token (str): The access token for the Spotify API
         """
+        data = {
+            "grant_type": "authorization_code",
+            "code": self.auth_code,
+            "redirect_uri": self.redirect_uri,
+        }
+
+        try:
+            return self.request_token(data)
+        except SpotifyTokenError as e:
+            print(e)
+            sys.exit(1)
+
+    def refresh_access_token(self: object) -> str:
+        """
+        Get a new access token using the stored refresh token.
+
+            Returns:
+                    token (str): The access token for the Spotify API
+        """
+        data = {
+            "grant_type": "refresh_token",
+            "refresh_token": self.refresh_token,
+        }
+
+        return self.request_token(data)
+
+    def get_valid_token(self: object, token: str) -> str:
+        """
+        Return the given token, or a refreshed one if it expires within a minute.
+
+            Parameters:
+                    token (str): The current access token for the Spotify API
+
+            Returns:
+                    token (str): A valid access token for the Spotify API
+        """
+        if self.refresh_token and time.time() > self.token_expires_at - 60:
+            return self.refresh_access_token()
+
+        return token
+
+    def request_token(self: object, data: dict[str, str]) -> str:
+        """
+        Request an access token from the Spotify accounts service.
+
+            Parameters:
+                    data (dict[str, str]): The form data describing the grant
+
+            Returns:
+                    token (str): The access token for the Spotify API
+
+            Raises:
+                    SpotifyTokenError: If the access token could not be fetched
+        """
         auth_string = self.client_id + ":" + self.client_secret
         auth_bytes = auth_string.encode("utf-8")
         auth_base64 = str(base64.b64encode(auth_bytes), "utf-8")
@@ -247,29 +335,31 @@ class SpotifyAPI:
             "Authorization": "Basic " + auth_base64,
             "Content-Type": "application/x-www-form-urlencoded"
         }
-        data = {
-            "grant_type": "authorization_code",
-            "code": self.auth_code,
-            "redirect_uri": self.redirect_uri,
-        }
 
         try:
-            result: Response = post(
+            result: Response = self.session.post(
                 url, headers=headers, data=data, timeout=10)
-        except requests.exceptions.Timeout:
-            print("The request to fetch the access token timed out after 10 seconds.")
-            sys.exit(1)
+        except requests.exceptions.Timeout as e:
+            raise SpotifyTokenError(
+                "The request to fetch the access token timed out after 10 seconds.") from e
         except Exception as e:
-            print(f"An error occurred while fetching the access token: {e}")
-            sys.exit(1)
+            raise SpotifyTokenError(
+                f"An error occurred while fetching the access token: {e}") from e
 
-        result_json = json.loads(result.content)
+        try:
+            result_json = json.loads(result.content)
+        except ValueError as e:
+            raise SpotifyTokenError(
+                f"An error occurred while fetching the access token: {e}") from e
 
         if "access_token" not in result_json:
-            print("An error occurred while fetching the access token")
-            sys.exit(1)
+            raise SpotifyTokenError(
+                "An error occurred while fetching the access token")
 
         token: str = result_json["access_token"]
+        # Spotify only returns a new refresh token occasionally, keep the old one otherwise
+        self.refresh_token = result_json.get("refresh_token", self.refresh_token)
+        self.token_expires_at = time.time() + result_json.get("expires_in", 3600)
 
         return token
 
@@ -306,7 +396,7 @@ class SpotifyAPI:
 
         while url:
             # TODO: Add timeout & try-except block for request timeout errors
-            response = get(url, headers=headers)
+            response = self.session.get(url, headers=headers)
             response_json = response.json()
 
             # if response code not 200, print error message
@@ -354,17 +444,31 @@ class SpotifyAPI:
 
         return playlists
 
-    def get_track_response(self: object, playlist_id: str, token: str) -> list[dict[str, str]]:
+    def get_track_response(
+        self: object,
+        playlist_id: str,
+        token: str,
+        snapshot_id: str | None = None
+    ) -> list[dict[str, str]]:
+        # An unchanged snapshot ID means the playlist has not changed since it was last paged
+        if snapshot_id is not None and playlist_id in self.track_response_cache:
+            cached_snapshot_id, cached_tracks = self.track_response_cache[playlist_id]
+            if cached_snapshot_id == snapshot_id:
+                return cached_tracks
+
         tracks: list[dict[str, str]] = []
         url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
         headers = self.get_auth_header(token)
         while url:
             # TODO: Add timeout & try-except block for request timeout errors
-            response: Response = get(url, headers=headers)
+            response: Response = self.session.get(url, headers=headers)
             response_json = response.json()
             tracks.extend(response_json["items"])
             url: str = response_json["next"]
 
+        if snapshot_id is not None:
+            self.track_response_cache[playlist_id] = (snapshot_id, tracks)
+
         return tracks
 
     @staticmethod
@@ -374,7 +478,16 @@ class SpotifyAPI:
         for track in track_response:
             metadata = {"search_string": "", "title": track["track"]["name"],
                         "artist": track["track"]["artists"][0]["name"], "album": "", "cover_art_url": "",
-                        "cover_art": None}
+                        "cover_art": None,
+                        "track_id": track["track"].get("id"),
+                        "artists": [artist["name"] for artist in track["track"]["artists"]],
+                        "artist_ids": [artist["id"] for artist in track["track"]["artists"] if artist.get("id")],
+                        "album_id": track["track"]["album"].get("id"),
+                        "track_number": track["track"].get("track_number"),
+                        "disc_number": track["track"].get("disc_number"),
+                        "total_tracks": track["track"]["album"].get("total_tracks"),
+                        "year": (track["track"]["album"].get("release_date") or "")[:4],
+                        "genres": []}
 
             metadata["search_string"] = metadata["title"] + \
                 " - " + metadata["artist"]
@@ -394,12 +507,11 @@ class SpotifyAPI:
 
         return track_details
 
-    @staticmethod
-    def download_track_image(image_url: str) -> Response | None:
+    def download_track_image(self: object, image_url: str) -> Response | None:
         image_response = None
 
         try:
-            image_response = get(image_url, timeout=10)
+            image_response = self.session.get(image_url, timeout=10)
             image_response.raise_for_status()
         except requests.exceptions.Timeout:
             # Do nothing
@@ -409,9 +521,12 @@ class SpotifyAPI:
 
         return image_response
 
-    def get_tracks(self, playlist_id, token, existing_tracks, playlist_name):
-        track_response = self.get_track_response(playlist_id, token)
-        track_details = self.extract_track_details(track_response)
+    def get_tracks(self, playlist_id, token, existing_tracks, playlist_name, snapshot_id=None):
+        with profile_stage("get_track_response"):
+            track_response = self.get_track_response(
+                playlist_id, token, snapshot_id)
+        with profile_stage("extract_track_details"):
+            track_details = self.extract_track_details(track_response)
 
         tracks_not_found = []
         number_of_downloads = 0
@@ -421,24 +536,34 @@ class SpotifyAPI:
         download_complete = False
         total_download_time = 0
 
+        tracks_to_download = []
         for metadata in track_details:
             if self.should_skip_track(metadata, existing_tracks):
                 number_of_skips += 1
                 download_complete = self.handle_skip(
                     download_complete, metadata)
                 continue
+            tracks_to_download.append(metadata)
 
-            image_response = self.download_track_image(
-                metadata["cover_art_url"])
-            if not self.handle_image_response(image_response, metadata):
-                continue
+        # Only tracks that are downloaded need album & artist details
+        with profile_stage("enrich_track_details"):
+            self.metadata_enricher.enrich(tracks_to_download, token)
 
-            youtube_api = YoutubeAPI()
-            video_url, video_title = youtube_api.get_video_url(
-                metadata["search_string"])
+        # Searches for upcoming tracks are resolved in the background while the current one downloads
+        youtube_api = self.youtube_api
+        search_prefetcher = SearchPrefetcher(
+            youtube_api.get_video_url, on_not_found=self.log_track_not_found)
+
+        for metadata, video_url, video_title in search_prefetcher.resolve(tracks_to_download):
             if not self.handle_video_url(video_url, metadata, tracks_not_found):
                 continue
 
+            with profile_stage("download_track_image"):
+                image_response = self.download_track_image(
+                    metadata["cover_art_url"])
+            if not self.handle_image_response(image_response, metadata):
+                continue
+
             number_of_downloads, total_download_time = self.download_track(
                 youtube_api,
                 video_title,
@@ -526,6 +651,11 @@ class SpotifyAPI:
         )
         Utils.console_print(image_download_error_string)
 
+    @staticmethod
+    def log_track_not_found(metadata):
+        not_found_string = f"\nNo video found for \"{metadata['search_string']}\"."
+        Utils.console_print(not_found_string)
+
     @staticmethod
     def log_download_progress(number_of_downloads, number_of_tracks, total_download_time):
         average_download_time = total_download_time / number_of_downloads
@@ -0,0 +1,369 @@
+import json
+import os
+import queue
+import threading
+import time
+import itertools
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from profiler import start_profiling, write_profile
+from utils import Utils
+
+
+class SyncJob:
+    """
+    A single playlist sync, queued either by the scheduler or through the job API.
+
+    Attributes:
+    -----------
+    job_id : int
+        Sequential ID of the job
+    playlist_id : str
+        The Spotify ID of the playlist to sync
+    source : str
+        What queued the job, "schedule" or "api"
+    status : str
+        One of "queued", "running", "done" or "failed"
+    result : dict[str, object] | None
+        Download counts and tracks not found, once the job is done
+    error : str | None
+        The error message, if the job failed
+    """
+
+    def __init__(self, job_id: int, playlist_id: str, source: str):
+        self.job_id: int = job_id
+        self.playlist_id: str = playlist_id
+        self.source: str = source
+        self.status: str = "queued"
+        self.created_at: float = time.time()
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self.result: dict[str, object] | None = None
+        self.error: str | None = None
+
+    def to_dict(self) -> dict[str, object]:
+        return {
+            "id": self.job_id,
+            "playlist_id": self.playlist_id,
+            "source": self.source,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class SyncHTTPServer(ThreadingHTTPServer):
+    """
+    HTTPServer class that gives request handlers access to the sync daemon.
+
+    Attributes:
+        sync_daemon : SyncDaemon
+            The daemon whose jobs are exposed through the API
+    """
+
+    def __init__(self, server_address, handler_class, sync_daemon):
+        super().__init__(server_address, handler_class)
+        self.sync_daemon: SyncDaemon = sync_daemon
+
+
+class SyncRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handle requests to the local job API.
+
+    Endpoints:
+    ----------
+        GET /status:
+            Queue depth, the running job and the configured schedule
+        GET /jobs:
+            All known jobs
+        GET /jobs/<id>:
+            A single job
+        POST /jobs?playlist_id=<id>:
+            Queue a sync of a playlist
+    """
+
+    # These method names do not follow PEP 8 naming conventions
+    # because they are required by the BaseHTTPRequestHandler class.
+    def do_GET(self) -> None:
+        """
+        Handle GET requests for the daemon status and jobs.
+
+        Returns:
+            None
+        """
+        sync_daemon = self.server.sync_daemon
+        path = urlparse(self.path).path.rstrip("/")
+
+        if path == "/status":
+            self.send_json(200, sync_daemon.get_status())
+        elif path == "/jobs":
+            self.send_json(200, [job.to_dict()
+                           for job in sync_daemon.get_jobs()])
+        elif path.startswith("/jobs/"):
+            job_id = path[len("/jobs/"):]
+            job = sync_daemon.get_job(
+                int(job_id)) if job_id.isdigit() else None
+            if job is None:
+                self.send_json(404, {"error": "Job not found."})
+            else:
+                self.send_json(200, job.to_dict())
+        else:
+            self.send_json(404, {"error": "Not found."})
+
+    def do_POST(self) -> None:
+        """
+        Handle POST requests that queue on-demand sync jobs.
+
+        Returns:
+            None
+        """
+        sync_daemon = self.server.sync_daemon
+        url = urlparse(self.path)
+
+        if url.path.rstrip("/") != "/jobs":
+            self.send_json(404, {"error": "Not found."})
+            return
+
+        playlist_id = parse_qs(url.query).get("playlist_id", [None])[0]
+        if not playlist_id:
+            self.send_json(
+                400, {"error": "The playlist_id parameter is required."})
+            return
+
+        job = sync_daemon.submit(playlist_id, "api")
+        self.send_json(202, job.to_dict())
+
+    def send_json(self, status_code: int, body: object) -> None:
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        # Keep the API requests out of the download progress output
+        pass
+
+
+class SyncDaemon:
+    """
+    Long-running sync service that keeps the Spotify token, HTTP session,
+    yt-dlp engine and track listings warm between playlist syncs.
+
+    Playlists listed in SYNC_PLAYLISTS are synced every SYNC_INTERVAL minutes,
+    other syncs can be queued through the local job API on DAEMON_PORT.
+
+    Attributes:
+    -----------
+    spotify_api : SpotifyAPI
+        The authorized Spotify API instance used for every sync
+    utils : Utils
+        Utils instance for the playlist directories
+    token : str
+        The current access token, refreshed before it expires
+    scheduled_playlists : list[str]
+        The playlist IDs synced on every scheduler run
+    sync_interval : int
+        Minutes between scheduled syncs
+    port : int
+        The port the job API listens on
+    profile : bool
+        Whether to write a profile for every job (--profile)
+    profile_stacks : bool
+        Whether the profiles include collapsed stacks (--profile-stacks)
+
+    Methods:
+    --------
+    run():
+        Start the worker and scheduler threads and serve the job API until interrupted.
+    submit(playlist_id, source):
+        Queue a sync of a playlist, unless one is already queued.
+    get_status():
+        Return the queue depth, the running job and the schedule.
+    get_jobs():
+        Return all known jobs.
+    get_job(job_id):
+        Return a single job.
+    """
+
+    # Finished jobs kept around for the status API
+    max_finished_jobs = 100
+
+    def __init__(
+        self,
+        spotify_api,
+        utils: Utils,
+        token: str,
+        profile: bool = False,
+        profile_stacks: bool = False
+    ):
+        self.spotify_api = spotify_api
+        self.utils: Utils = utils
+        self.token: str = token
+        self.profile: bool = profile
+        self.profile_stacks: bool = profile_stacks
+
+        self.scheduled_playlists: list[str] = [
+            playlist_id.strip()
+            for playlist_id in os.getenv("SYNC_PLAYLISTS", "").split(",")
+            if playlist_id.strip()
+        ]
+        self.sync_interval: int = int(os.getenv("SYNC_INTERVAL", "60"))
+        self.port: int = int(os.getenv("DAEMON_PORT", "8081"))
+
+        self.jobs: dict[int, SyncJob] = {}
+        self.job_queue: queue.Queue[SyncJob] = queue.Queue()
+        self.current_job: SyncJob | None = None
+        self.job_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+        # Playlist name & snapshot ID, keyed by playlist ID
+        self.playlists: dict[str, dict[str, str]] = {}
+
+    def run(self) -> None:
+        threading.Thread(target=self.worker_loop, daemon=True).start()
+        if self.scheduled_playlists:
+            threading.Thread(target=self.scheduler_loop, daemon=True).start()
+
+        httpd = SyncHTTPServer(
+            ('localhost', self.port), SyncRequestHandler, self)
+        print(f"Sync daemon listening on http://localhost:{self.port}")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            print("\nStopping sync daemon.")
+        finally:
+            self.stop_event.set()
+            httpd.server_close()
+
+    def submit(self, playlist_id: str, source: str) -> SyncJob:
+        with self.lock:
+            # A queued sync of the same playlist covers this request. A running one does not,
+            # it fetched the playlist when it started and would miss any change since
+            for job in self.jobs.values():
+                if job.playlist_id == playlist_id and job.status == "queued":
+                    return job
+
+            job = SyncJob(next(self.job_ids), playlist_id, source)
+            self.jobs[job.job_id] = job
+            self.prune_jobs()
+
+        self.job_queue.put(job)
+        return job
+
+    def prune_jobs(self) -> None:
+        finished = [job for job in self.jobs.values()
+                    if job.status in ("done", "failed")]
+        for job in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self.jobs[job.job_id]
+
+    def get_status(self) -> dict[str, object]:
+        with self.lock:
+            current_job = self.current_job.to_dict() if self.current_job else None
+        return {
+            "queue_depth": self.job_queue.qsize(),
+            "current_job": current_job,
+            "scheduled_playlists": self.scheduled_playlists,
+            "sync_interval_minutes": self.sync_interval,
+        }
+
+    def get_jobs(self) -> list[SyncJob]:
+        with self.lock:
+            return list(self.jobs.values())
+
+    def get_job(self, job_id: int) -> SyncJob | None:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def scheduler_loop(self) -> None:
+        while not self.stop_event.is_set():
+            for playlist_id in self.scheduled_playlists:
+                self.submit(playlist_id, "schedule")
+            self.stop_event.wait(self.sync_interval * 60)
+
+    def worker_loop(self) -> None:
+        while not self.stop_event.is_set():
+            job = self.job_queue.get()
+            with self.lock:
+                self.current_job = job
+                job.status = "running"
+                job.started_at = time.time()
+
+            try:
+                result = self.run_job(job)
+            # SystemExit included, a failed job must never take the worker thread down with it
+            except (Exception, SystemExit) as e:
+                with self.lock:
+                    job.status = "failed"
+                    job.error = str(e)
+                print(f"An error occurred while syncing {job.playlist_id}: {e}")
+            else:
+                with self.lock:
+                    job.status = "done"
+                    job.result = result
+            finally:
+                with self.lock:
+                    job.finished_at = time.time()
+                    self.current_job = None
+                self.job_queue.task_done()
+
+    def refresh_playlists(self) -> None:
+        playlists_response = self.spotify_api.get_playlist_response(
+            self.token)
+        self.playlists = {
+            playlist["id"]: {
+                "name": playlist["name"],
+                "snapshot_id": playlist.get("snapshot_id"),
+            }
+            for playlist in playlists_response
+        }
+
+    def run_job(self, job: SyncJob) -> dict[str, object]:
+        self.token = self.spotify_api.get_valid_token(self.token)
+
+        # The playlist listing is one paged request, it is what tells us
+        # whether the cached track listing of a playlist is still current
+        self.refresh_playlists()
+        if job.playlist_id not in self.playlists:
+            raise ValueError(f"Unknown playlist ID: {job.playlist_id}")
+
+        playlist = self.playlists[job.playlist_id]
+        sanitized_playlist_name = Utils.sanitize_filename(playlist["name"])
+        Utils.console_print(f"\nSyncing playlist: {playlist['name']}")
+
+        self.utils.create_playlist_directory(sanitized_playlist_name)
+        existing_tracks = self.utils.get_existing_tracks(
+            sanitized_playlist_name)
+
+        # Profiled here, on the worker thread, as cProfile only records the thread that enables it
+        profiler = start_profiling(
+            self.profile_stacks) if self.profile else None
+        try:
+            tracks_not_found, number_of_downloads, number_of_skips = self.spotify_api.get_tracks(
+                job.playlist_id,
+                self.token,
+                existing_tracks,
+                sanitized_playlist_name,
+                playlist["snapshot_id"]
+            )
+        finally:
+            if profiler is not None:
+                write_profile(
+                    profiler,
+                    os.path.join(self.utils.downloads_dir,
+                                 sanitized_playlist_name),
+                    f"{time.strftime('%Y%m%d-%H%M%S')}-job{job.job_id}"
+                )
+
+        return {
+            "playlist_name": playlist["name"],
+            "tracks_downloaded": number_of_downloads,
+            "tracks_skipped": number_of_skips,
+            "tracks_not_found": tracks_not_found,
+        }
@@ -4,6 +4,10 @@ import re
 import locale
 import os
 import logging
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
 
 
 class Logger:
@@ -30,6 +34,81 @@ class Logger:
         self.log.error(msg)
 
 
+class ScratchSpace:
+    """
+    Local staging directory (SCRATCH_DIR) for downloads and transcodes, so only
+    the final tagged file is written to the downloads directory.
+
+    SCRATCH_MAX_JOBS limits how many tracks are staged at once by concurrent callers and
+    SCRATCH_MIN_FREE_MB is the free space required before staging another one.
+    Without SCRATCH_DIR, tracks are downloaded straight to their destination.
+    """
+
+    def __init__(self):
+        self.scratch_dir = os.getenv("SCRATCH_DIR")
+        self.min_free_bytes = int(
+            os.getenv("SCRATCH_MIN_FREE_MB", "512")) * 1024 * 1024
+        # Only limits callers that stage tracks concurrently, the CLI & daemon download one at a time
+        self.slots = threading.BoundedSemaphore(
+            max(1, int(os.getenv("SCRATCH_MAX_JOBS", "2"))))
+
+        if self.scratch_dir:
+            os.makedirs(self.scratch_dir, exist_ok=True)
+
+    @staticmethod
+    def has_free_space(path, required_bytes):
+        return shutil.disk_usage(path).free >= required_bytes
+
+    @contextmanager
+    def stage(self):
+        """
+        Reserve a private staging directory, removed again on exit.
+
+        Yields None when scratch space is disabled or too full, in which case
+        the caller should work in the destination directory instead.
+        """
+        if not self.scratch_dir:
+            yield None
+            return
+
+        with self.slots:
+            if not self.has_free_space(self.scratch_dir, self.min_free_bytes):
+                print(
+                    f"Not enough free space in {self.scratch_dir}, "
+                    "downloading straight to the downloads directory.")
+                yield None
+                return
+
+            path = tempfile.mkdtemp(prefix="pld-", dir=self.scratch_dir)
+            try:
+                yield path
+            finally:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def move_to_destination(self, file_path, destination_dir):
+        file_size = os.path.getsize(file_path)
+        if not self.has_free_space(destination_dir, file_size):
+            print(
+                f"Not enough free space in {destination_dir} for {os.path.basename(file_path)}.")
+            return None
+
+        # Copy under a temporary name first, so an interrupted copy is never
+        # mistaken for an already downloaded track
+        destination = os.path.join(
+            destination_dir, os.path.basename(file_path))
+        partial_destination = destination + ".part"
+        try:
+            shutil.copyfile(file_path, partial_destination)
+            os.replace(partial_destination, destination)
+        except OSError:
+            if os.path.exists(partial_destination):
+                os.remove(partial_destination)
+            raise
+        os.remove(file_path)
+
+        return destination
+
+
 class Utils:
     def __init__(self):
         self.downloads_dir = os.getenv("DOWNLOADS_DIR")
@@ -4,19 +4,58 @@ import time
 from youtubesearchpython import VideosSearch
 from yt_dlp import YoutubeDL
 from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, APIC, TIT2, TPE1, TALB
+from mutagen.id3 import ID3, APIC, TIT2, TPE1, TALB, TXXX, TDRC, TRCK, TPOS, TCON
 
-from utils import Utils, Logger
+from profiler import profile_stage
+from utils import Utils, Logger, ScratchSpace
 
 
 class YoutubeAPI:
     def __init__(self):
         self.downloads_dir = os.getenv("DOWNLOADS_DIR")
+        self.ydl = None
+        self.scratch_space = ScratchSpace()
+        # MP3 bitrate in kbps
+        self.audio_quality = int(os.getenv("AUDIO_QUALITY", "192"))
+
+    @staticmethod
+    def get_format_selector(audio_quality):
+        # Formats are sorted by audio bitrate, then size. Take the smallest audio-only
+        # stream at or above the target bitrate, else the best audio-only stream below it,
+        # and only fall back to a muxed video if there is no audio-only stream at all.
+        return f"wa[abr>={audio_quality}]/ba/b"
+
+    def get_ydl_opts(self):
+        return {
+            'format': self.get_format_selector(self.audio_quality),
+            'format_sort': ['abr', 'size'],
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'mp3',
+                'preferredquality': str(self.audio_quality),
+            }],
+            'logger': Logger(),
+            "quiet": True,
+        }
+
+    def get_downloader(self, output_template):
+        # Reuse one YoutubeDL instance so extractors and the ffmpeg postprocessor
+        # are only set up once, only the output template changes between songs
+        if self.ydl is None:
+            self.ydl = YoutubeDL(self.get_ydl_opts())
+        self.ydl.params['outtmpl'] = {'default': output_template}
+        return self.ydl
+
+    def close_downloader(self):
+        if self.ydl is not None:
+            self.ydl.close()
+            self.ydl = None
 
     @staticmethod
     def get_video_url(song_name):
-        videos_search = VideosSearch(song_name, limit=1)
-        result = videos_search.result()
+        with profile_stage("search"):
+            videos_search = VideosSearch(song_name, limit=1)
+            result = videos_search.result()
 
         if (
             not isinstance(result, dict) or
@@ -40,11 +79,11 @@ class YoutubeAPI:
         return video_url, video_title
 
     @staticmethod
-    def add_metadata(mp3_file, metadata):
-        audio = MP3(mp3_file, ID3=ID3)
+    def get_metadata_frames(metadata):
+        frames = []
 
         if metadata["cover_art"] is not None:
-            audio.tags.add(
+            frames.append(
                 APIC(
                     encoding=3,
                     mime='image/jpeg',
@@ -54,62 +93,149 @@ class YoutubeAPI:
                 )
             )
 
-        audio.tags.add(
+        # Lets a retag tell whether the embedded cover is still current without downloading it
+        if metadata["cover_art"] is not None and metadata["cover_art_url"]:
+            frames.append(
+                TXXX(
+                    encoding=3,
+                    desc='Cover Art URL',
+                    text=metadata["cover_art_url"]
+                )
+            )
+
+        # Lets a retag find the file again after the track's title or artist changed
+        if metadata["track_id"]:
+            frames.append(
+                TXXX(
+                    encoding=3,
+                    desc='Spotify Track ID',
+                    text=metadata["track_id"]
+                )
+            )
+
+        frames.append(
             TIT2(
                 encoding=3,
                 text=metadata["title"]
             )
         )
 
-        audio.tags.add(
+        frames.append(
             TPE1(
                 encoding=3,
-                text=metadata["artist"]
+                text=metadata["artists"] or metadata["artist"]
             )
         )
 
-        audio.tags.add(
+        frames.append(
             TALB(
                 encoding=3,
                 text=metadata["album"]
             )
         )
 
+        if metadata["year"]:
+            frames.append(
+                TDRC(
+                    encoding=3,
+                    text=metadata["year"]
+                )
+            )
+
+        if metadata["track_number"]:
+            track_number = str(metadata["track_number"])
+            if metadata["total_tracks"]:
+                track_number += f"/{metadata['total_tracks']}"
+            frames.append(
+                TRCK(
+                    encoding=3,
+                    text=track_number
+                )
+            )
+
+        if metadata["disc_number"]:
+            frames.append(
+                TPOS(
+                    encoding=3,
+                    text=str(metadata["disc_number"])
+                )
+            )
+
+        if metadata["genres"]:
+            frames.append(
+                TCON(
+                    encoding=3,
+                    text=metadata["genres"]
+                )
+            )
+
+        return frames
+
+    @staticmethod
+    def add_metadata(mp3_file, metadata):
+        audio = MP3(mp3_file, ID3=ID3)
+        if audio.tags is None:
+            audio.add_tags()
+
+        for frame in YoutubeAPI.get_metadata_frames(metadata):
+            audio.tags.add(frame)
+
         audio.save()
 
-    def download_song(self, video_url, song_title, playlist_name):
+    @staticmethod
+    def frame_differs(existing_frame, frame):
+        if existing_frame is None:
+            return True
+        if isinstance(frame, APIC):
+            return existing_frame.data != frame.data
+        # Compared as strings, timestamp frames hold ID3TimeStamp values
+        return [str(text) for text in existing_frame.text] != [str(text) for text in frame.text]
+
+    @staticmethod
+    def update_metadata(mp3_file, metadata):
+        """
+        Rewrite only the tags that differ from the metadata, the audio data is left untouched.
+        Returns the IDs of the frames that were rewritten.
+        """
+        audio = MP3(mp3_file, ID3=ID3)
+        if audio.tags is None:
+            audio.add_tags()
+
+        changed_frames = []
+        for frame in YoutubeAPI.get_metadata_frames(metadata):
+            if YoutubeAPI.frame_differs(audio.tags.get(frame.HashKey), frame):
+                audio.tags.add(frame)
+                changed_frames.append(frame.FrameID)
+
+        if changed_frames:
+            audio.save()
+
+        return changed_frames
+
+    def download_song(self, video_url, song_title, playlist_name, output_path=None):
         mp3_file = None
 
         song_title = Utils.sanitize_filename(song_title)
-        output_path = os.path.join(self.downloads_dir, playlist_name)
+        if output_path is None:
+            output_path = os.path.join(self.downloads_dir, playlist_name)
         output_template = os.path.join(output_path, song_title + ".%(ext)s")
 
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'outtmpl': output_template,
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
-            'logger': Logger(),
-            "quiet": True,
-        }
-
         # Retry up to 3 times
         for _ in range(3):
             try:
-                with YoutubeDL(ydl_opts) as ydl:
-                    error_code = ydl.download([video_url])
-                    if error_code != 0:
-                        print(
-                            f"Failed to download {song_title} ( {video_url} ) with error code {error_code}")
-                        return None
+                ydl = self.get_downloader(output_template)
+                error_code = ydl.download([video_url])
+                if error_code != 0:
+                    print(
+                        f"Failed to download {song_title} ( {video_url} ) with error code {error_code}")
+                    return None
                 mp3_file = output_template.replace('.%(ext)s', '.mp3')
                 break
             except Exception as e:
                 print(
                     f"Failed to download {song_title} ( {video_url} ) with error: {e}")
+                # Start the next attempt with a fresh downloader
+                self.close_downloader()
                 time.sleep(1)
 
         if mp3_file is None:
@@ -121,12 +247,20 @@ class YoutubeAPI:
 
     def download_song_wrapper(self, _video_title, video_url, playlist_name, metadata):
         try:
-            mp3_file = self.download_song(
-                video_url, metadata["title"], playlist_name)
+            # Download, transcode & tag in scratch space, then move the finished file
+            with self.scratch_space.stage() as scratch_path:
+                with profile_stage("download_song"):
+                    mp3_file = self.download_song(
+                        video_url, metadata["title"], playlist_name, scratch_path)
+
+                if mp3_file is None:
+                    return
 
-            if mp3_file is None:
-                return
+                with profile_stage("add_metadata"):
+                    self.add_metadata(mp3_file, metadata)
 
-            self.add_metadata(mp3_file, metadata)
+                if scratch_path is not None:
+                    self.scratch_space.move_to_destination(
+                        mp3_file, os.path.join(self.downloads_dir, playlist_name))
         except Exception as e:
             print(f"An error occurred: {e}")